@@ -1,10 +1,15 @@
 # mars_chronicles_full.py
 import streamlit as st
 import json
-import uuid
+import secrets
+import textwrap
+import threading
 import time
-from openai import OpenAI
-from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import httpx
+import msgpack
+from openai import DefaultHttpxClient, OpenAI
 
 ## --------------------------
 ## Configuration & Constants
@@ -18,16 +23,18 @@ DEFAULT_PROFILE = {
     "progress": 0,
     "inventory": [],
     "location": "Mars Colony Alpha",
-    "story_id": str(uuid.uuid4()),
     "created": False,
+    "synopsis": "",
     "locations": [
-        {"name": "Mars Colony Alpha", "image": "images/colony_alpha.jpg"},
-        {"name": "Olympus Mons Outpost", "image": "images/olympus_mons.jpg"},
-        {"name": "Valles Marineris Hub", "image": "images/valles_marineris.jpg"},
-        {"name": "Polar Caps Station", "image": "images/polar_caps.jpg"}
+        {"name": "Mars Colony Alpha", "image": "images/colony_alpha_sidebar.jpg"},
+        {"name": "Olympus Mons Outpost", "image": "images/olympus_mons_sidebar.jpg"},
+        {"name": "Valles Marineris Hub", "image": "images/valles_marineris_sidebar.jpg"},
+        {"name": "Polar Caps Station", "image": "images/polar_caps_sidebar.jpg"}
     ]
 }
 
+GENDERS = ("Male", "Female", "Non-binary", "Other")
+
 GENRES = [
     "Sci-Fi", "Mystery", "Romance", "Horror", "Comedy",
     "Political Thriller", "Cyberpunk", "Survival", "Historical Fiction", "Noir"
@@ -39,6 +46,40 @@ EARTH_ORIGINS = [
     "Dubai, Earth", "Nairobi, Earth"
 ]
 
+# Selectbox defaults, looked up by value instead of list.index() on each rerun
+_GENDER_IDX = {g: i for i, g in enumerate(GENDERS)}
+_GENRE_IDX = {g: i for i, g in enumerate(GENRES)}
+_ORIGIN_IDX = {o: i for i, o in enumerate(EARTH_ORIGINS)}
+
+# Dedented once at import so indentation isn't sent as prompt tokens
+STORY_PROMPT = textwrap.dedent("""\
+    Generate a branching narrative segment for a Mars colony story with:
+    - Protagonist: {name}
+    - Gender: {gender}
+    - Age: {age}
+    - Earth Origin: {origin}
+    - Genre: {genre}
+    - Current location: {location}
+    - Prior summary: {synopsis}
+    - Previous context: {context}
+
+    Format rules:
+    1. Incorporate character background
+    2. 2-3 paragraph story segment
+    3. End with 2-4 numbered choices
+    4. Maintain continuity""")
+
+_CHOICE_PREFIXES = ("1.", "2.", "3.", "4.")
+
+# How long pooled API connections may sit idle before httpx closes them
+_KEEPALIVE_SECONDS = 120
+
+# Recent choices are sent verbatim; older ones are folded into the synopsis
+_HISTORY_KEEP = 3
+_SYNOPSIS_EVERY = 5
+_SYNOPSIS_CHARS = 60
+_SYNOPSIS_MAX = 600
+
 ## --------------------------
 ## Cached Resources
 ## --------------------------
@@ -46,75 +87,308 @@ EARTH_ORIGINS = [
 def get_api_client():
     return OpenAI(
         api_key=st.secrets["DEEPSEEK_KEY"],
-        base_url="https://api.deepseek.com"
+        base_url="https://api.deepseek.com",
+        # httpx drops idle sockets after 5s by default, well before a player
+        # finishes the creation form or reads a chapter
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=1000,
+                max_keepalive_connections=100,
+                keepalive_expiry=_KEEPALIVE_SECONDS
+            )
+        )
     )
 
-@st.cache_data
+@st.cache_resource
+def get_prefetch_executor():
+    # Visible requests stream on their session's script thread; only
+    # speculative work waits for a slot here
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_segment_cache():
+    return SegmentCache(max_entries=512, ttl=3600)
+
+@st.cache_resource(max_entries=8)
 def load_image(path: str):
+    """Read a pre-sized location image as raw bytes so st.image serves it as-is"""
     try:
-        return Image.open(path)
+        with open(path, "rb") as f:
+            return f.read()
     except FileNotFoundError:
         return None
 
 ## --------------------------
 ## Core Game Functionality
 ## --------------------------
+def warm_up_api():
+    """Open the API connection in the background so the first story request skips the TLS handshake"""
+    try:
+        client = get_api_client()
+    except Exception:
+        # A warm-up must never break the page; story requests report the error
+        return
+    threading.Thread(target=_ping_api, args=(client,), daemon=True).start()
+
+def _ping_api(client):
+    try:
+        client.models.list()
+    except Exception:
+        pass
+
+class StorySegment:
+    """A story request that may still be streaming; ``text`` grows as tokens arrive"""
+
+    def __init__(self, executor=None):
+        self.text = ""
+        # None when the request runs on a session's script thread
+        self.executor = executor
+        self.future = Future()
+
+    def run(self, client, fields: tuple, on_text=None):
+        """Request the segment and record the outcome on ``future``"""
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = _request_segment(client, fields, self, on_text)
+        except Exception as e:
+            self.future.set_exception(e)
+            raise
+        except BaseException:
+            # Streamlit stopping the script mid-stream; let the next caller retry
+            self.future.set_exception(RuntimeError("story request was interrupted"))
+            raise
+        self.future.set_result(result)
+
+class SegmentCache:
+    """Process-wide LRU of story segments keyed by their prompt fields.
+
+    Entries hold the request's future, so a prompt that is still being
+    generated is waited on instead of being sent again. Streamlit's own
+    caches don't work off the script thread, hence this one.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._ttl = ttl
+
+    def claim(self, fields: tuple, executor=None, preempt: bool = False) -> tuple:
+        """Return ``(segment, created)``; a created segment must be run by the caller.
+
+        With ``preempt``, an entry still queued on an executor is cancelled
+        so the caller can run it on its own thread instead.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(fields)
+            if entry is not None:
+                created, segment = entry
+                future = segment.future
+                if preempt and segment.executor is not None:
+                    future.cancel()
+                failed = future.cancelled() or (future.done() and future.exception() is not None)
+                if now - created < self._ttl and not failed:
+                    self._entries.move_to_end(fields)
+                    return segment, False
+            
+            segment = StorySegment(executor)
+            self._entries[fields] = (now, segment)
+            self._entries.move_to_end(fields)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return segment, True
+
+    def submit(self, fields: tuple, client, executor) -> StorySegment:
+        """Return the segment for ``fields``, requesting it on ``executor`` if needed"""
+        segment, created = self.claim(fields, executor)
+        if created:
+            executor.submit(segment.run, client, fields)
+        return segment
+
+def _request_segment(client, fields: tuple, segment: StorySegment, on_text=None) -> tuple[str, list[str]]:
+    """Stream a story segment into ``segment.text`` and parse it.
+    May run on a worker thread, so it must not touch st.session_state or st caches."""
+    name, gender, age, origin, genre, location, synopsis, context = fields
+    response = client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[{
+            "role": "system",
+            "content": STORY_PROMPT.format(
+                name=name,
+                gender=gender,
+                age=age,
+                origin=origin,
+                genre=genre,
+                location=location,
+                synopsis=synopsis or "None",
+                context=context
+            )
+        }],
+        temperature=0.7,
+        top_p=0.9,
+        max_tokens=700,
+        stream=True
+    )
+    
+    for chunk in response:
+        if chunk.choices:
+            segment.text += chunk.choices[0].delta.content or ""
+            if on_text is not None:
+                on_text(segment.text)
+    
+    story_lines, choices = [], []
+    for line in segment.text.split("\n"):
+        if line.startswith(_CHOICE_PREFIXES):
+            choices.append(line[3:].lstrip())
+        else:
+            story_lines.append(line)
+    # Raising keeps an unusable reply out of the cache so the next rerun retries
+    if not choices:
+        raise ValueError("no choices in reply")
+    story_text = "\n".join(story_lines)
+    return story_text, choices[:4]
+
+def segment_fields(location: str, synopsis: str, context: str) -> tuple:
+    """Prompt fields for a story segment, which double as its cache key"""
+    user_data = st.session_state.user_data
+    return (
+        user_data['name'],
+        user_data['gender'],
+        user_data['age'],
+        user_data['origin'],
+        user_data['genre'],
+        location,
+        synopsis,
+        context
+    )
+
 def generate_story_segment(context: str) -> tuple:
     """Generate story segment with 2-4 choices using DeepSeek R1"""
+    user_data = st.session_state.user_data
+    fields = segment_fields(user_data['location'], user_data['synopsis'], context)
+    
+    # Render tokens as they arrive; a cache hit returns without streaming
+    placeholder = st.empty()
     try:
         client = get_api_client()
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{
-                "role": "system",
-                "content": f"""Generate a branching narrative segment for a Mars colony story with:
-                - Protagonist: {st.session_state.user_data['name']} 
-                - Gender: {st.session_state.user_data['gender']}
-                - Age: {st.session_state.user_data['age']}
-                - Earth Origin: {st.session_state.user_data['origin']}
-                - Genre: {st.session_state.user_data['genre']}
-                - Current location: {st.session_state.user_data['location']}
-                - Previous context: {context}
-                
-                Format rules:
-                1. Incorporate character background
-                2. 2-3 paragraph story segment
-                3. End with 2-4 numbered choices
-                4. Maintain continuity"""
-            }],
-            temperature=0.7,
-            top_p=0.9,
-            max_tokens=1500
-        )
-        
-        full_text = response.choices[0].message.content
-        story_text = "\n".join([line for line in full_text.split("\n") if not line.startswith(('1.', '2.', '3.', '4.'))])
-        choices = [line[3:] for line in full_text.split("\n") if line.startswith(tuple(f"{i}." for i in range(1,5)))]
-        
-        # Update location based on progress
-        progress = st.session_state.user_data['progress'] + 1
-        if progress < len(st.session_state.user_data['locations']):
-            st.session_state.user_data['location'] = st.session_state.user_data['locations'][progress]['name']
-        
-        return story_text, choices[:4]
-    
+        with st.spinner("Generating your Mars adventure..."):
+            segment, created = get_segment_cache().claim(fields, preempt=True)
+            if created:
+                # This session's own request streams on its script thread
+                segment.run(client, fields, on_text=placeholder.markdown)
+            else:
+                # Already in flight elsewhere, usually a prefetch
+                shown = ""
+                while not segment.future.done():
+                    wait([segment.future], timeout=0.05)
+                    if segment.text != shown:
+                        shown = segment.text
+                        placeholder.markdown(shown)
+        placeholder.empty()
+        return segment.future.result()
     except Exception as e:
+        placeholder.empty()
         st.error(f"Story generation failed: {str(e)}")
         return None, []
 
+def save_game_state() -> bytes:
+    """Serialize the current game for download, reusing the payload until the story advances"""
+    user_data = st.session_state.user_data
+    payload_key = (id(user_data), user_data['progress'], len(st.session_state.story_choices))
+    cached = st.session_state.get("save_cache")
+    if cached is None or cached[0] != payload_key:
+        cached = (payload_key, msgpack.packb(user_data, use_bin_type=True))
+        st.session_state.save_cache = cached
+    return cached[1]
+
+def load_game_state(uploaded_file):
+    """Restore a saved game, accepting older JSON saves as well"""
+    raw = uploaded_file.read()
+    try:
+        data = msgpack.unpackb(raw, raw=False)
+    except (msgpack.UnpackException, ValueError):
+        data = json.loads(raw)
+    # Locations are app config; older saves point at the full-size images
+    data.pop('locations', None)
+    st.session_state.user_data.update(data)
+    st.session_state.pop("save_cache", None)
+    index_locations()
+
+def compact_history(history: list, synopsis: str) -> tuple:
+    """Fold all but the most recent choices into the synopsis every few chapters"""
+    if len(history) < _HISTORY_KEEP + _SYNOPSIS_EVERY:
+        return history, synopsis
+    dropped = [choice[:_SYNOPSIS_CHARS] for choice in history[:-_HISTORY_KEEP]]
+    synopsis = " ".join([synopsis, *dropped]).strip()[-_SYNOPSIS_MAX:]
+    return history[-_HISTORY_KEEP:], synopsis
+
+def chapter_location(progress: int) -> str:
+    """Chapter N takes place at the Nth colony location"""
+    locations = st.session_state.user_data['locations']
+    if progress < len(locations):
+        return locations[progress]['name']
+    return st.session_state.user_data['location']
+
+def cancel_prefetch(keep: str = None):
+    """Cancel queued speculative requests, except the one behind ``keep``"""
+    executor = get_prefetch_executor()
+    for choice, (_, segment) in st.session_state.get("prefetch", {}).items():
+        # Entries shared from the cache may belong to someone's visible request
+        if choice != keep and segment.executor is executor:
+            segment.future.cancel()
+
+def prefetch_next_segments(choices: list):
+    """Generate the chapter behind each choice in the background while the user reads"""
+    user_data = st.session_state.user_data
+    progress = user_data['progress'] + 1
+    location = chapter_location(progress)
+    
+    cancel_prefetch()
+    
+    cache = get_segment_cache()
+    client = get_api_client()
+    executor = get_prefetch_executor()
+    st.session_state.prefetch = {}
+    for choice in choices:
+        history, synopsis = compact_history(
+            st.session_state.story_choices + [choice],
+            user_data['synopsis']
+        )
+        context = " ".join(history[-_HISTORY_KEEP:])
+        segment = cache.submit(segment_fields(location, synopsis, context), client, executor)
+        ctx_key = (context, progress, user_data['genre'], location)
+        st.session_state.prefetch[choice] = (ctx_key, segment)
+
+def make_choice(choice: str):
+    """Button callback: advance the story before the next script run starts"""
+    st.session_state.user_data['progress'] += 1
+    st.session_state.story_choices, st.session_state.user_data['synopsis'] = compact_history(
+        st.session_state.story_choices + [choice],
+        st.session_state.user_data['synopsis']
+    )
+    
+    cancel_prefetch(keep=choice)
+    
+    # Serve the next chapter straight from a finished prefetch; one still
+    # running is picked up from the segment cache on the next run
+    next_key, segment = st.session_state.get("prefetch", {}).get(choice, (None, None))
+    future = segment.future if segment else None
+    if future and future.done() and not future.cancelled() and future.exception() is None:
+        next_text, next_choices = future.result()
+        if next_text and next_choices:
+            st.session_state.last_story_text = next_text
+            st.session_state.last_choices = next_choices
+            st.session_state.last_ctx_key = next_key
+
 ## --------------------------
 ## UI Components
 ## --------------------------
-def show_loading(message="Generating your Mars adventure..."):
-    """Modern loading screen"""
-    with st.spinner(message):
-        time.sleep(1.5)
-
 def show_colony_map():
     """Display current colony map"""
     location_name = st.session_state.user_data['location']
-    location = next((loc for loc in st.session_state.user_data['locations'] 
-                    if loc['name'] == location_name), None)
+    location = st.session_state.location_index.get(location_name)
     
     if location:
         img = load_image(location['image'])
@@ -127,6 +401,25 @@ def show_colony_map():
 ## --------------------------
 ## Main Application Flow
 ## --------------------------
+def index_locations():
+    """Map location names to their entries for O(1) lookups"""
+    st.session_state.location_index = {
+        loc['name']: loc for loc in st.session_state.user_data['locations']
+    }
+
+def init_session():
+    """Initialize session state"""
+    if 'user_data' not in st.session_state:
+        st.session_state.user_data = DEFAULT_PROFILE.copy()
+        st.session_state.user_data['story_id'] = secrets.token_hex(8)
+    if 'story_choices' not in st.session_state:
+        st.session_state.story_choices = []
+    if 'location_index' not in st.session_state:
+        index_locations()
+    if 'api_warmed' not in st.session_state:
+        st.session_state.api_warmed = True
+        warm_up_api()
+
 def main():
     st.set_page_config(
         page_title="Mars Chronicles 2035",
@@ -134,11 +427,7 @@ def main():
         layout="wide"
     )
     
-    # Initialize session state
-    if 'user_data' not in st.session_state:
-        st.session_state.user_data = DEFAULT_PROFILE.copy()
-    if 'story_choices' not in st.session_state:
-        st.session_state.story_choices = []
+    init_session()
     
     # Character Creation
     if not st.session_state.user_data['created']:
@@ -147,27 +436,27 @@ def main():
         with st.form("character_creation"):
             st.header("Create Your Character")
             
-            name = st.text_input("Character Name", value=DEFAULT_PROFILE['name'])
+            name = st.text_input("Character Name", value=st.session_state.user_data['name'])
             gender = st.selectbox(
                 "Gender Identity",
-                ["Male", "Female", "Non-binary", "Other"],
-                index=2
+                GENDERS,
+                index=_GENDER_IDX.get(st.session_state.user_data['gender'], 2)
             )
             age = st.number_input(
                 "Character Age (Earth Years)",
                 min_value=1,
                 max_value=125,
-                value=25
+                value=st.session_state.user_data['age']
             )
             origin = st.selectbox(
                 "Earth Origin",
                 EARTH_ORIGINS,
-                index=0
+                index=_ORIGIN_IDX.get(st.session_state.user_data['origin'], 0)
             )
             genre = st.selectbox(
                 "Story Genre", 
                 GENRES, 
-                index=0
+                index=_GENRE_IDX.get(st.session_state.user_data['genre'], 0)
             )
             
             if st.form_submit_button("Begin Your Mars Adventure"):
@@ -179,12 +468,13 @@ def main():
                     "genre": genre,
                     "created": True
                 })
-                show_loading("Initializing your Mars colony...")
                 st.rerun()
         
         return
     
     # Main Game Interface
+    st.session_state.user_data['location'] = chapter_location(st.session_state.user_data['progress'])
+    
     with st.sidebar:
         st.header("Martian Colony Map")
         show_colony_map()
@@ -192,15 +482,16 @@ def main():
         st.header("Game Controls")
         st.download_button(
             label="💾 Save Progress",
-            data=json.dumps(st.session_state.user_data),
-            file_name=f"mars_story_{st.session_state.user_data['story_id']}.json",
-            mime="application/json"
+            data=save_game_state(),
+            file_name=f"mars_story_{st.session_state.user_data['story_id']}.msgpack",
+            mime="application/octet-stream"
         )
-        uploaded_file = st.file_uploader("⬆️ Load Game", type=["json"])
-        if uploaded_file:
+        uploaded_file = st.file_uploader("⬆️ Load Game", type=["msgpack", "json"])
+        # The uploader keeps returning the same file on later reruns; load it once
+        if uploaded_file and uploaded_file.file_id != st.session_state.get("loaded_file_id"):
+            st.session_state.loaded_file_id = uploaded_file.file_id
             try:
-                data = json.load(uploaded_file)
-                st.session_state.user_data.update(data)
+                load_game_state(uploaded_file)
                 st.success("Game loaded successfully!")
             except Exception as e:
                 st.error(f"Invalid save file: {str(e)}")
@@ -209,23 +500,39 @@ def main():
     
     # Generate Story Content
     context = "New story" if st.session_state.user_data['progress'] == 0 else \
-              " ".join(st.session_state.story_choices[-3:])
+              " ".join(st.session_state.story_choices[-_HISTORY_KEEP:])
+    
+    st.markdown(f"### Chapter {st.session_state.user_data['progress'] + 1}")
     
-    story_text, choices = generate_story_segment(context)
+    # Reruns that don't advance the story reuse the last segment
+    ctx_key = (
+        context,
+        st.session_state.user_data['progress'],
+        st.session_state.user_data['genre'],
+        st.session_state.user_data['location']
+    )
+    if st.session_state.get("last_ctx_key") == ctx_key:
+        story_text = st.session_state.last_story_text
+        choices = st.session_state.last_choices
+    else:
+        story_text, choices = generate_story_segment(context)
+        if story_text and choices:
+            st.session_state.last_story_text = story_text
+            st.session_state.last_choices = choices
+            st.session_state.last_ctx_key = ctx_key
     
     if story_text and choices:
-        st.markdown(f"### Chapter {st.session_state.user_data['progress'] + 1}")
         st.markdown(story_text)
         
         # Display choices
         cols = st.columns(min(len(choices), 4))
         for idx, choice in enumerate(choices):
             with cols[idx % 4]:
-                if st.button(choice, key=f"choice_{idx}"):
-                    st.session_state.user_data['progress'] += 1
-                    st.session_state.story_choices.append(choice)
-                    show_loading()
-                    st.rerun()
+                st.button(choice, key=f"choice_{idx}", on_click=make_choice, args=(choice,))
+        
+        if st.session_state.get("prefetch_key") != ctx_key:
+            prefetch_next_segments(choices)
+            st.session_state.prefetch_key = ctx_key
     elif not choices:
         st.warning("Failed to generate valid story choices. Try again!")
 